@@ -10,12 +10,14 @@ from models.arch_util import ResBlock
 from models.audio.music.gpt_music2 import UpperEncoder, GptMusicLower
 from models.audio.music.music_quantizer2 import MusicQuantizer2
 from models.audio.tts.lucidrains_dvae import DiscreteVAE
-from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
+from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear, \
+    nearest_interpolation_indices
 from models.diffusion.unet_diffusion import TimestepBlock
 from models.lucidrains.x_transformers import Encoder, Attention, RMSScaleShiftNorm, RotaryEmbedding, \
     FeedForward
 from trainer.networks import register_model
-from utils.util import checkpoint, print_network
+import utils.util
+from utils.util import opt_get, possible_checkpoint, print_network
 
 
 def is_latent(t):
@@ -47,29 +49,30 @@ class TimestepRotaryEmbedSequential(nn.Sequential, TimestepBlock):
 
 
 class SubBlock(nn.Module):
-    def __init__(self, inp_dim, contraction_dim, heads, dropout):
+    def __init__(self, inp_dim, contraction_dim, heads, dropout, use_checkpoint=True):
         super().__init__()
+        self.use_checkpoint = use_checkpoint
         self.attn = Attention(inp_dim, out_dim=contraction_dim, heads=heads, dim_head=contraction_dim//heads, causal=False, dropout=dropout)
         self.attnorm = nn.LayerNorm(contraction_dim)
         self.ff = nn.Conv1d(inp_dim+contraction_dim, contraction_dim, kernel_size=3, padding=1)
         self.ffnorm = nn.LayerNorm(contraction_dim)
 
     def forward(self, x, rotary_emb):
-        ah, _, _, _ = checkpoint(self.attn, x, None, None, None, None, None, rotary_emb)
+        ah, _, _, _ = possible_checkpoint(self.use_checkpoint, self.attn, x, None, None, None, None, None, rotary_emb)
         ah = F.gelu(self.attnorm(ah))
         h = torch.cat([ah, x], dim=-1)
-        hf = checkpoint(self.ff, h.permute(0,2,1)).permute(0,2,1)
+        hf = possible_checkpoint(self.use_checkpoint, self.ff, h.permute(0,2,1)).permute(0,2,1)
         hf = F.gelu(self.ffnorm(hf))
         h = torch.cat([h, hf], dim=-1)
         return h
 
 
 class ConcatAttentionBlock(TimestepBlock):
-    def __init__(self, trunk_dim, contraction_dim, time_embed_dim, heads, dropout):
+    def __init__(self, trunk_dim, contraction_dim, time_embed_dim, heads, dropout, use_checkpoint=True):
         super().__init__()
         self.prenorm = RMSScaleShiftNorm(trunk_dim, embed_dim=time_embed_dim, bias=False)
-        self.block1 = SubBlock(trunk_dim, contraction_dim, heads, dropout)
-        self.block2 = SubBlock(trunk_dim+contraction_dim*2, contraction_dim, heads, dropout)
+        self.block1 = SubBlock(trunk_dim, contraction_dim, heads, dropout, use_checkpoint)
+        self.block2 = SubBlock(trunk_dim+contraction_dim*2, contraction_dim, heads, dropout, use_checkpoint)
         self.out = mbnb.nn.Linear(contraction_dim*4, trunk_dim, bias=False)
         self.out.weight.data.zero_()
 
@@ -107,12 +110,18 @@ class TransformerDiffusion(nn.Module):
             unconditioned_percentage=.1,  # This implements a mechanism similar to what is used in classifier-free training.
             # Parameters for re-training head
             freeze_except_code_converters=False,
+            use_checkpoint=True,  # Disable when compiling this model; checkpointing causes graph breaks.
+            max_timesteps=4000,  # Integer timesteps are embedded via a precomputed lookup table and must be below this.
     ):
         super().__init__()
 
         self.in_channels = in_channels
         self.model_channels = model_channels
         self.prenet_channels = prenet_channels
+        self.use_checkpoint = use_checkpoint
+        # Follows the `ddp_static_graph` trainer option. A static DDP graph does not need the per-parameter dummy
+        # reductions that otherwise keep unused parameters in the graph.
+        self.ddp_static = opt_get(utils.util.loaded_options, ['ddp_static_graph'], False)
         self.time_embed_dim = time_embed_dim
         self.out_channels = out_channels
         self.dropout = dropout
@@ -129,6 +138,7 @@ class TransformerDiffusion(nn.Module):
             nn.SiLU(),
             linear(time_embed_dim, time_embed_dim),
         )
+        self.register_buffer('time_table', timestep_embedding(torch.arange(max_timesteps), time_embed_dim), persistent=False)
 
         prenet_heads = prenet_channels//64
         self.input_converter = mbnb.nn.Linear(input_vec_dim, prenet_channels)
@@ -143,12 +153,13 @@ class TransformerDiffusion(nn.Module):
                     rotary_pos_emb=True,
                     zero_init_branch_output=True,
                     ff_mult=1,
+                    attn_use_sdpa=True,
                 )
 
         self.unconditioned_embedding = nn.Parameter(torch.randn(1,1,prenet_channels))
         self.rotary_embeddings = RotaryEmbedding(rotary_emb_dim)
         self.intg = mbnb.nn.Linear(prenet_channels*2, model_channels)
-        self.layers = TimestepRotaryEmbedSequential(*[ConcatAttentionBlock(model_channels, contraction_dim, time_embed_dim, num_heads, dropout) for _ in range(num_layers)])
+        self.layers = TimestepRotaryEmbedSequential(*[ConcatAttentionBlock(model_channels, contraction_dim, time_embed_dim, num_heads, dropout, use_checkpoint) for _ in range(num_layers)])
 
         self.out = nn.Sequential(
             normalization(model_channels),
@@ -191,6 +202,15 @@ class TransformerDiffusion(nn.Module):
         }
         return groups
 
+    def embed_timesteps(self, timesteps):
+        # Integer timesteps must be below max_timesteps and are looked up in the table. Fractional timesteps fall back to
+        # computing the embedding directly. Decided on dtype alone so no host sync or graph break is needed.
+        if timesteps.dim() == 1 and not timesteps.is_floating_point():
+            # Checked on-device so an out-of-range timestep fails with an assertion instead of an opaque indexing error.
+            torch._assert_async((timesteps < self.time_table.shape[0]).all())
+            return self.time_table.index_select(0, timesteps)
+        return timestep_embedding(timesteps, self.time_embed_dim)
+
     def timestep_independent(self, prior, expected_seq_len):
         if self.new_code_expansion:
             prior = F.interpolate(prior.permute(0,2,1), size=expected_seq_len, mode='linear', align_corners=self.use_corner_alignment).permute(0,2,1)
@@ -199,24 +219,22 @@ class TransformerDiffusion(nn.Module):
 
         # Mask out the conditioning branch for whole batch elements, implementing something similar to classifier-free guidance.
         if self.training and self.unconditioned_percentage > 0:
-            unconditioned_batches = torch.rand((code_emb.shape[0], 1, 1),
-                                               device=code_emb.device) < self.unconditioned_percentage
-            code_emb = torch.where(unconditioned_batches, self.unconditioned_embedding.repeat(prior.shape[0], 1, 1),
-                                   code_emb)
+            unconditioned_batches = torch.rand((code_emb.shape[0],), device=code_emb.device) < self.unconditioned_percentage
+            code_emb = torch.where(unconditioned_batches[:, None, None], self.unconditioned_embedding, code_emb)
 
         if not self.new_code_expansion:
-            code_emb = F.interpolate(code_emb.permute(0,2,1), size=expected_seq_len, mode='nearest').permute(0,2,1)
+            code_emb = code_emb.index_select(1, nearest_interpolation_indices(code_emb.shape[1], expected_seq_len, code_emb.device))
         return code_emb
 
     def forward(self, x, timesteps, codes=None, conditioning_input=None, precomputed_code_embeddings=None, conditioning_free=False):
         if precomputed_code_embeddings is not None:
             assert codes is None and conditioning_input is None, "Do not provide precomputed embeddings and the other parameters. It is unclear what you want me to do here."
-        if self.permute_codes:
+        if self.permute_codes and codes is not None:
             codes = codes.permute(0,2,1)
 
         unused_params = []
         if conditioning_free:
-            code_emb = self.unconditioned_embedding.repeat(x.shape[0], x.shape[-1], 1)
+            code_emb = self.unconditioned_embedding.expand(x.shape[0], x.shape[-1], -1)
         else:
             if precomputed_code_embeddings is not None:
                 code_emb = precomputed_code_embeddings
@@ -225,63 +243,110 @@ class TransformerDiffusion(nn.Module):
             unused_params.append(self.unconditioned_embedding)
 
         with torch.autocast(x.device.type, enabled=self.enable_fp16):
-            blk_emb = self.time_embed(timestep_embedding(timesteps, self.time_embed_dim))
+            blk_emb = self.time_embed(self.embed_timesteps(timesteps))
             x = self.inp_block(x).permute(0,2,1)
 
             rotary_pos_emb = self.rotary_embeddings(x.shape[1], x.device)
             x = self.intg(torch.cat([x, code_emb], dim=-1))
             for layer in self.layers:
-                x = checkpoint(layer, x, blk_emb, rotary_pos_emb)
+                x = possible_checkpoint(self.use_checkpoint, layer, x, blk_emb, rotary_pos_emb)
 
         x = x.float().permute(0,2,1)
         out = self.out(x)
 
         # Involve probabilistic or possibly unused parameters in loss so we don't get DDP errors.
-        extraneous_addition = 0
-        for p in unused_params:
-            extraneous_addition = extraneous_addition + p.mean()
-        out = out + extraneous_addition * 0
+        if self.ddp_static:
+            if unused_params:
+                out = out + self.unconditioned_embedding.sum() * 0
+        else:
+            extraneous_addition = 0
+            for p in unused_params:
+                extraneous_addition = extraneous_addition + p.mean()
+            out = out + extraneous_addition * 0
 
         return out
 
 
 class TransformerDiffusionWithQuantizer(nn.Module):
     def __init__(self, quantizer_dims=[1024], quantizer_codebook_size=256, quantizer_codebook_groups=2,
-                 freeze_quantizer_until=20000, **kwargs):
+                 freeze_quantizer_until=20000, compile_diffusion=False, **kwargs):
         super().__init__()
 
         self.internal_step = 0
         self.freeze_quantizer_until = freeze_quantizer_until
+        self.compile_diffusion = compile_diffusion
+        if compile_diffusion:
+            assert hasattr(nn.Module, 'compile'), 'compile_diffusion requires torch>=2.2 (nn.Module.compile).'
+            kwargs['use_checkpoint'] = False
         self.diff = TransformerDiffusion(**kwargs)
+        if compile_diffusion:
+            # Compiled in-place so that state_dict keys are unchanged. max-autotune also enables GEMM autotuning.
+            self.diff.compile(mode='max-autotune')
         self.quantizer = MusicQuantizer2(inp_channels=kwargs['in_channels'], inner_dim=quantizer_dims,
                                          codevector_dim=quantizer_dims[0], codebook_size=quantizer_codebook_size,
                                          codebook_groups=quantizer_codebook_groups, max_gumbel_temperature=4,
                                          min_gumbel_temperature=.5)
         self.quantizer.quantizer.temperature = self.quantizer.min_gumbel_temperature
         del self.quantizer.up
+        self._ddp_static_quantizer_frozen = None
 
     def update_for_step(self, step, *args):
         self.internal_step = step
+        if self.diff.ddp_static:
+            # The static DDP graph is recorded with the quantizer either frozen or trainable; it cannot switch mid-run.
+            frozen = step <= self.freeze_quantizer_until
+            if self._ddp_static_quantizer_frozen is None:
+                self._ddp_static_quantizer_frozen = frozen
+            elif self._ddp_static_quantizer_frozen != frozen:
+                raise RuntimeError(f'The quantizer unfreezes at step {self.freeze_quantizer_until + 1}, which changes '
+                                   f'the set of trained parameters under ddp_static_graph. Stop the run at step '
+                                   f'{self.freeze_quantizer_until} and resume from there.')
         qstep = max(0, self.internal_step - self.freeze_quantizer_until)
         self.quantizer.quantizer.temperature = max(
             self.quantizer.max_gumbel_temperature * self.quantizer.gumbel_temperature_decay ** qstep,
                     self.quantizer.min_gumbel_temperature,
                 )
 
-    def forward(self, x, timesteps, truth_mel, conditioning_input=None, disable_diversity=False, conditioning_free=False):
+    def precompute(self, truth_mel, expected_seq_len):
+        """
+        Runs the quantizer and the timestep-independent part of the diffusion network, which do not change across the
+        steps of a sampling loop. Pass the result to forward() as `precomputed_code_embeddings`.
+        """
+        with torch.no_grad():
+            proj, _ = self.quantizer(truth_mel, return_decoder_latent=True)
+            proj = proj.permute(0,2,1)
+            if self.diff.permute_codes:
+                proj = proj.permute(0,2,1)
+            code_emb = self.diff.timestep_independent(proj, expected_seq_len)
+        return code_emb
+
+    def forward(self, x, timesteps, truth_mel=None, conditioning_input=None, disable_diversity=False, conditioning_free=False,
+                precomputed_code_embeddings=None):
+        if precomputed_code_embeddings is not None:
+            diff = self.diff(x, timesteps, precomputed_code_embeddings=precomputed_code_embeddings, conditioning_free=conditioning_free)
+            if disable_diversity:
+                return diff
+            return diff, torch.zeros((), device=diff.device)
+
         quant_grad_enabled = self.internal_step > self.freeze_quantizer_until
         with torch.set_grad_enabled(quant_grad_enabled):
             proj, diversity_loss = self.quantizer(truth_mel, return_decoder_latent=True)
             proj = proj.permute(0,2,1)
 
-        # Make sure this does not cause issues in DDP by explicitly using the parameters for nothing.
+        # Make sure this does not cause issues in DDP by explicitly using the parameters for nothing. A static DDP graph
+        # already accounts for the frozen quantizer (update_for_step() enforces that it stays frozen for the run).
         if not quant_grad_enabled:
-            unused = 0
-            for p in self.quantizer.parameters():
-                unused = unused + p.mean() * 0
-            proj = proj + unused
+            if not self.diff.ddp_static:
+                unused = 0
+                for p in self.quantizer.parameters():
+                    unused = unused + p.mean() * 0
+                proj = proj + unused
             diversity_loss = diversity_loss * 0
 
+        if self.compile_diffusion:
+            # Sequence length varies between batches; only specialize on the other dimensions.
+            torch._dynamo.mark_dynamic(x, 2)
+            torch._dynamo.mark_dynamic(proj, 1)
         diff = self.diff(x, timesteps, codes=proj, conditioning_input=conditioning_input, conditioning_free=conditioning_free)
         if disable_diversity:
             return diff
@@ -1,3 +1,4 @@
+import functools
 import itertools
 
 import torch
@@ -9,7 +10,7 @@ from models.audio.music.encoders import ResEncoder16x
 from models.audio.music.transformer_diffusion13 import ConcatAttentionBlock
 from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
 from trainer.networks import register_model
-from utils.util import checkpoint, print_network
+from utils.util import possible_checkpoint, print_network
 
 
 class TransformerDiffusion(nn.Module):
@@ -34,6 +35,8 @@ class TransformerDiffusion(nn.Module):
             unconditioned_percentage=.1,  # This implements a mechanism similar to what is used in classifier-free training.
             # Parameters for re-training head
             freeze_except_code_converters=False,
+            # Number of gradient checkpoints to split the layer stack into. Defaults to one checkpoint per layer.
+            checkpoint_segments=None,
     ):
         super().__init__()
 
@@ -46,6 +49,7 @@ class TransformerDiffusion(nn.Module):
         self.enable_fp16 = use_fp16
         self.new_code_expansion = new_code_expansion
         self.use_corner_alignment = use_corner_alignment
+        self.layers_per_checkpoint = 1 if checkpoint_segments is None else -(-num_layers // checkpoint_segments)
         self.inp_block = conv_nd(1, in_channels, model_channels, 3, 1, 1)
 
         self.time_embed = nn.Sequential(
@@ -75,6 +79,33 @@ class TransformerDiffusion(nn.Module):
                     del p.DO_NOT_TRAIN
                     p.requires_grad = True
 
+        self._fused_input = None
+        self._fused_input_key = None
+
+    def fused_input_weights(self):
+        """
+        intg is a 1x1 conv, so intg(cat([inp_block(x), code_emb])) is equivalent to a 3-tap conv over x (inp_block
+        folded into the first half of intg) plus a 1x1 conv over code_emb. This skips the intermediate projection of x
+        and the cat. The folded weights are rebuilt whenever the source parameters are modified in place (optimizer
+        steps, EMA updates, load_state_dict).
+        """
+        srcs = (self.inp_block.weight, self.inp_block.bias, self.intg.weight, self.intg.bias)
+        key = tuple((t.data_ptr(), t._version) for t in srcs)
+        if key != self._fused_input_key:
+            with torch.no_grad(), torch.autocast(self.intg.weight.device.type, enabled=False):
+                w_h = self.intg.weight[:, :self.model_channels, 0]
+                w_x = torch.einsum('om,mik->oik', w_h, self.inp_block.weight)
+                w_c = self.intg.weight[:, self.model_channels:].contiguous()
+                b = w_h @ self.inp_block.bias + self.intg.bias
+            self._fused_input = (w_x, w_c, b)
+            self._fused_input_key = key
+        return self._fused_input
+
+    def run_layers(self, x, blk_emb, start, end):
+        for i in range(start, min(end, len(self.layers))):
+            x = self.layers[i](x, blk_emb)
+        return x
+
     def get_grad_norm_parameter_groups(self):
         attn1 = list(itertools.chain.from_iterable([lyr.block1.attn.parameters() for lyr in self.layers]))
         attn2 = list(itertools.chain.from_iterable([lyr.block2.attn.parameters() for lyr in self.layers]))
@@ -116,11 +147,16 @@ class TransformerDiffusion(nn.Module):
 
         with torch.autocast(x.device.type, enabled=self.enable_fp16):
             blk_emb = self.time_embed(timestep_embedding(timesteps, self.time_embed_dim))
-            x = self.inp_block(x)
-
-            x = self.intg(torch.cat([x, code_emb], dim=1))
-            for layer in self.layers:
-                x = checkpoint(layer, x, blk_emb)
+            if self.training or torch.is_grad_enabled():
+                x = self.inp_block(x)
+                x = self.intg(torch.cat([x, code_emb], dim=1))
+            else:
+                w_x, w_c, b = self.fused_input_weights()
+                x = F.conv1d(x, w_x, b, padding=1) + F.conv1d(code_emb, w_c)
+            do_checkpoint = self.training and torch.is_grad_enabled()
+            for start in range(0, len(self.layers), self.layers_per_checkpoint):
+                segment = functools.partial(self.run_layers, start=start, end=start+self.layers_per_checkpoint)
+                x = possible_checkpoint(do_checkpoint, segment, x, blk_emb)
 
         x = x.float()
         out = self.out(x)
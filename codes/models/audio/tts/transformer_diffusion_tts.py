@@ -2,7 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
-from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
+from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear, \
+    nearest_interpolation_indices
 from models.diffusion.unet_diffusion import TimestepEmbedSequential, TimestepBlock
 from models.lucidrains.x_transformers import Encoder, Attention, FeedForward, RMSScaleShiftNorm, RotaryEmbedding
 from trainer.networks import register_model
@@ -20,12 +21,21 @@ def is_sequence(t):
 class MultiGroupEmbedding(nn.Module):
     def __init__(self, tokens, groups, dim):
         super().__init__()
-        # nn.Embedding
-        self.m = nn.ModuleList([mbnb.nn.Embedding(tokens, dim // groups) for _ in range(groups)])
+        self.groups = groups
+        # All groups share one table; group i occupies rows [i*tokens, (i+1)*tokens).
+        self.emb = mbnb.nn.Embedding(tokens * groups, dim // groups)
+        self.register_buffer('offsets', torch.arange(groups) * tokens, persistent=False)
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Older checkpoints store a separate table per group.
+        legacy_keys = [f'{prefix}m.{i}.weight' for i in range(self.groups)]
+        if all(k in state_dict for k in legacy_keys):
+            state_dict[f'{prefix}emb.weight'] = torch.cat([state_dict.pop(k) for k in legacy_keys], dim=0)
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
 
     def forward(self, x):
-        h = [embedding(x[:, :, i]) for i, embedding in enumerate(self.m)]
-        return torch.cat(h, dim=-1)
+        h = self.emb(x + self.offsets)
+        return h.flatten(-2)
 
 
 class TimestepRotaryEmbedSequential(nn.Sequential, TimestepBlock):
@@ -182,7 +192,7 @@ class TransformerDiffusionTTS(nn.Module):
                                    code_emb)
         code_emb = self.code_converter(code_emb)
 
-        expanded_code_emb = F.interpolate(code_emb.permute(0,2,1), size=expected_seq_len, mode='nearest').permute(0,2,1)
+        expanded_code_emb = code_emb.index_select(1, nearest_interpolation_indices(code_emb.shape[1], expected_seq_len, code_emb.device))
         if not return_code_pred:
             return expanded_code_emb, cond_emb
         else:
@@ -208,7 +218,7 @@ class TransformerDiffusionTTS(nn.Module):
         if not return_code_pred:
             unused_params.extend(list(self.mel_head.parameters()))
         if conditioning_free:
-            code_emb = self.unconditioned_embedding.repeat(x.shape[0], 1, x.shape[-1])
+            code_emb = self.unconditioned_embedding.expand(x.shape[0], x.shape[-1], -1)
             unused_params.extend(list(self.code_converter.parameters()) + list(self.code_embedding.parameters()))
             unused_params.extend(list(self.latent_conditioner.parameters()))
         else:
@@ -225,12 +235,13 @@ class TransformerDiffusionTTS(nn.Module):
         type_emb = self.type_embedding(type)
         if clvp_input is None:
             unused_params.extend(self.clvp_encoder.parameters())
-        blk_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels)) + cond_emb + clvp_emb + type_emb
-        x = self.inp_block(x).permute(0,2,1)
+        with torch.autocast(x.device.type, dtype=torch.bfloat16, enabled=self.enable_fp16):
+            blk_emb = self.time_embed(timestep_embedding(timesteps, self.model_channels)) + cond_emb + clvp_emb + type_emb
+            x = self.inp_block(x).permute(0,2,1)
 
-        rotary_pos_emb = self.rotary_embeddings(x.shape[1], x.device)
-        x = self.intg(torch.cat([x, code_emb], dim=-1))
-        x = self.layers(x, blk_emb, rotary_pos_emb)
+            rotary_pos_emb = self.rotary_embeddings(x.shape[1], x.device)
+            x = self.intg(torch.cat([x, code_emb], dim=-1))
+            x = self.layers(x, blk_emb, rotary_pos_emb)
 
         x = x.float().permute(0,2,1)
         out = self.out(x)
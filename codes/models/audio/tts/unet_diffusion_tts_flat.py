@@ -7,11 +7,12 @@ import torch.nn.functional as F
 from torch import autocast
 import maybe_bnb as mbnb
 
+from models.diffusion.fused_ops import group_norm_scale_shift_silu
 from models.diffusion.nn import timestep_embedding, normalization, zero_module, conv_nd, linear
 from models.diffusion.unet_diffusion import TimestepEmbedSequential, TimestepBlock, QKVAttentionLegacy
 from models.lucidrains.x_transformers import RelativePositionBias
 from trainer.networks import register_model
-from utils.util import checkpoint
+from utils.util import possible_checkpoint
 
 
 def is_latent(t):
@@ -62,10 +63,39 @@ class AttentionBlock(nn.Module):
         b, c, *spatial = x.shape
         x = x.reshape(b, c, -1)
         qkv = self.qkv(self.norm(x))
-        h = self.attention(qkv, mask, self.relative_pos_embeddings)
+        h = None
+        if mask is None and hasattr(F, 'scaled_dot_product_attention'):
+            h = self._fused_attention(qkv)
+        if h is None:
+            h = self.attention(qkv, mask, self.relative_pos_embeddings)
         h = self.proj_out(h)
         return (x + h).reshape(b, c, *spatial)
 
+    def _fused_attention(self, qkv):
+        """
+        Computes the same thing as QKVAttentionLegacy, but lets torch dispatch to a fused (flash/memory-efficient)
+        attention kernel so the full TxT attention matrix never needs to be materialized. Relative position embeddings
+        are fed in as an additive attention bias. Returns None if the kernel rejects the inputs.
+        """
+        bs, width, length = qkv.shape
+        ch = width // (3 * self.num_heads)
+        # The fused kernels require the head dimension to be contiguous.
+        q, k, v = qkv.reshape(bs, self.num_heads, ch * 3, length).permute(0, 1, 3, 2).contiguous().split(ch, dim=-1)
+        bias = None
+        if self.relative_pos_embeddings is not None:
+            bias = self.relative_pos_embeddings(qkv.new_zeros((1, 1, length, length), dtype=torch.float)).to(q.dtype)
+        try:
+            a = F.scaled_dot_product_attention(q, k, v, attn_mask=bias)
+        except torch.cuda.OutOfMemoryError:
+            # The legacy path needs even more memory; don't retry on it.
+            raise
+        except RuntimeError as e:
+            # Only fall back when no kernel accepts the inputs (e.g. an unsupported dtype or head size).
+            if 'kernel' not in str(e):
+                raise
+            return None
+        return a.transpose(-1, -2).reshape(bs, -1, length)
+
 
 class ResBlock(TimestepBlock):
     def __init__(
@@ -102,6 +132,8 @@ class ResBlock(TimestepBlock):
                 2 * self.out_channels if use_scale_shift_norm else self.out_channels,
             ),
         )
+        # Broadcasts the embedding over the spatial dims of h.
+        self._emb_view_shape = (-1, 2 * self.out_channels if use_scale_shift_norm else self.out_channels) + (1,) * dims
         self.out_layers = nn.Sequential(
             normalization(self.out_channels),
             nn.SiLU(),
@@ -124,19 +156,17 @@ class ResBlock(TimestepBlock):
         :param emb: an [N x emb_channels] Tensor of timestep embeddings.
         :return: an [N x C x ...] Tensor of outputs.
         """
-        return checkpoint(
-            self._forward, x, emb
-        )
+        # Checkpointing only pays off when a backward pass follows; skip it for eval/sampling.
+        return possible_checkpoint(self.training and torch.is_grad_enabled(), self._forward, x, emb)
 
     def _forward(self, x, emb):
         h = self.in_layers(x)
-        emb_out = self.emb_layers(emb).type(h.dtype)
-        while len(emb_out.shape) < len(h.shape):
-            emb_out = emb_out[..., None]
+        emb_out = self.emb_layers(emb).type(h.dtype).view(self._emb_view_shape)
         if self.use_scale_shift_norm:
-            out_norm, out_rest = self.out_layers[0], self.out_layers[1:]
+            # out_layers[1] is the SiLU, which is fused into the norm epilogue.
+            out_norm, out_rest = self.out_layers[0], self.out_layers[2:]
             scale, shift = torch.chunk(emb_out, 2, dim=1)
-            h = out_norm(h) * (1 + scale) + shift
+            h = group_norm_scale_shift_silu(h, out_norm, scale, shift)
             h = out_rest(h)
         else:
             h = h + emb_out
@@ -2,6 +2,7 @@
 Various utilities for neural networks.
 """
 
+import functools
 import math
 
 import torch as th
@@ -133,6 +134,19 @@ def timestep_embedding(timesteps, dim, max_period=10000):
     return embedding
 
 
+@functools.lru_cache(maxsize=256)
+def nearest_interpolation_indices(in_len, out_len, device):
+    """
+    Compute the indices that F.interpolate(mode='nearest') samples when resizing a sequence from in_len to out_len, so
+    the resize can be done as a gather along any axis (e.g. without permuting a [N x T x C] Tensor). Results are cached
+    since the same lengths recur on every diffusion step.
+
+    :return: a 1-D LongTensor of out_len indices on the given device.
+    """
+    idx = (th.arange(out_len, device=device, dtype=th.float32) * (in_len / out_len)).long()
+    return idx.clamp_(max=in_len - 1)
+
+
 def checkpoint(func, inputs, params, flag):
     """
     Evaluate a function without caching intermediate activations, allowing for
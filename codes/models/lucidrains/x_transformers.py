@@ -521,7 +521,8 @@ class Attention(nn.Module):
             rel_pos_bias=False,
             rel_pos_num_buckets=32,
             rel_pos_max_distance=128,
-            mup_scale=False
+            mup_scale=False,
+            use_sdpa=False
     ):
         super().__init__()
         self.scale = 8/dim_head if mup_scale else dim_head ** -0.5
@@ -592,10 +593,59 @@ class Attention(nn.Module):
             self.rel_pos = RelativePositionBias(scale=dim_head ** 0.5, causal=causal, heads=heads,
                                                 num_buckets=rel_pos_num_buckets, max_distance=rel_pos_max_distance)
 
+        # fused attention kernel; only for configurations that never need the full attention matrix
+        self.use_sdpa = use_sdpa and hasattr(F, 'scaled_dot_product_attention') and not (
+                talking_heads or exists(sparse_topk) or use_entmax15 or qk_norm or exists(max_attend_past))
+
         # init output projection 0
         if zero_init_output:
             init_zero_(self.to_out)
 
+    def sdp_attend(self, q, k, v, scale, input_mask=None, attn_mask=None):
+        """
+        Computes softmax(q @ k^T * scale + bias) @ v with F.scaled_dot_product_attention, folding the relative position
+        bias and all masks into a single additive bias. Returns None if no kernel accepts the inputs.
+        """
+        i, j = q.shape[-2], k.shape[-2]
+        bias = None
+        if self.rel_pos_bias:
+            bias = self.rel_pos(q.new_zeros((1, self.heads, i, j)))
+
+        mask = input_mask
+        if exists(attn_mask):
+            if attn_mask.ndim == 2:
+                attn_mask = rearrange(attn_mask, 'i j -> () () i j')
+            elif attn_mask.ndim == 3:
+                attn_mask = rearrange(attn_mask, 'h i j -> () h i j')
+            mask = attn_mask if mask is None else mask & attn_mask
+
+        is_causal = self.causal and bias is None and mask is None and i == j
+        if self.causal and not is_causal:
+            r = torch.arange(i, device=q.device)
+            causal_mask = rearrange(r, 'i -> () () i ()') >= rearrange(r, 'j -> () () () j')
+            causal_mask = F.pad(causal_mask, (j - i, 0), value=True)
+            mask = causal_mask if mask is None else mask & causal_mask
+
+        if exists(mask):
+            # Fill with a finite value like the einsum path does, so fully masked rows stay well defined.
+            bias = torch.where(mask, default(bias, lambda: q.new_zeros(())), max_neg_value(q))
+
+        # The scale= keyword only exists from torch 2.1, so fold any non-default scale into q instead.
+        if scale != q.shape[-1] ** -0.5:
+            q = q * (scale * q.shape[-1] ** 0.5)
+
+        try:
+            return F.scaled_dot_product_attention(q, k, v, attn_mask=bias, is_causal=is_causal,
+                                                  dropout_p=self.dropout.p if self.training else 0.)
+        except torch.cuda.OutOfMemoryError:
+            # The einsum path needs even more memory; don't retry on it.
+            raise
+        except RuntimeError as e:
+            # Only fall back when no kernel accepts the inputs (e.g. an unsupported dtype or head size).
+            if 'kernel' not in str(e):
+                raise
+            return None
+
     def forward(
             self,
             x,
@@ -674,65 +724,73 @@ class Attention(nn.Module):
             q, k = map(l2norm, (q, k))
             scale = 1 / (self.scale.exp().clamp(min=1e-2))
 
-        dots = einsum('b h i d, b h j d -> b h i j', q, k) * scale
-        mask_value = max_neg_value(dots)
+        out = None
+        if self.use_sdpa and not exists(prev_attn):
+            out = self.sdp_attend(q, k, v, scale, input_mask, attn_mask)
 
-        if exists(prev_attn):
-            dots = dots + prev_attn
-
-        pre_softmax_attn = dots.clone()
-
-        if talking_heads:
-            dots = einsum('b h i j, h k -> b k i j', dots, self.pre_softmax_proj).contiguous()
+        if exists(out):
+            # The fused kernel never materializes the attention matrix.
+            pre_softmax_attn = post_softmax_attn = None
+        else:
+            dots = einsum('b h i d, b h j d -> b h i j', q, k) * scale
+            mask_value = max_neg_value(dots)
 
-        if self.rel_pos_bias:
-            dots = self.rel_pos(dots)
+            if exists(prev_attn):
+                dots = dots + prev_attn
 
-        if exists(input_mask):
-            dots.masked_fill_(~input_mask, mask_value)
-            del input_mask
+            pre_softmax_attn = dots.clone()
 
-        if exists(attn_mask):
-            assert 2 <= attn_mask.ndim <= 4, 'attention mask must have greater than 2 dimensions but less than or equal to 4'
-            if attn_mask.ndim == 2:
-                attn_mask = rearrange(attn_mask, 'i j -> () () i j')
-            elif attn_mask.ndim == 3:
-                attn_mask = rearrange(attn_mask, 'h i j -> () h i j')
-            dots.masked_fill_(~attn_mask, mask_value)
-
-        if exists(self.max_attend_past):
-            i, j = dots.shape[-2:]
-            range_q = torch.arange(j - i, j, device=device)
-            range_k = torch.arange(j, device=device)
-            dist = rearrange(range_q, 'i -> () () i ()') - rearrange(range_k, 'j -> () () () j')
-            mask = dist > self.max_attend_past
-            dots.masked_fill_(mask, mask_value)
-            del mask
-
-        if self.causal:
-            i, j = dots.shape[-2:]
-            r = torch.arange(i, device=device)
-            mask = rearrange(r, 'i -> () () i ()') < rearrange(r, 'j -> () () () j')
-            mask = F.pad(mask, (j - i, 0), value=False)
-            dots.masked_fill_(mask, mask_value)
-            del mask
-
-        if exists(self.sparse_topk) and self.sparse_topk < dots.shape[-1]:
-            top, _ = dots.topk(self.sparse_topk, dim=-1)
-            vk = top[..., -1].unsqueeze(-1).expand_as(dots)
-            mask = dots < vk
-            dots.masked_fill_(mask, mask_value)
-            del mask
-
-        attn = self.attn_fn(dots, dim=-1)
-        post_softmax_attn = attn.clone()
-
-        attn = self.dropout(attn)
+            if talking_heads:
+                dots = einsum('b h i j, h k -> b k i j', dots, self.pre_softmax_proj).contiguous()
 
-        if talking_heads:
-            attn = einsum('b h i j, h k -> b k i j', attn, self.post_softmax_proj).contiguous()
+            if self.rel_pos_bias:
+                dots = self.rel_pos(dots)
 
-        out = einsum('b h i j, b h j d -> b h i d', attn, v)
+            if exists(input_mask):
+                dots.masked_fill_(~input_mask, mask_value)
+                del input_mask
+
+            if exists(attn_mask):
+                assert 2 <= attn_mask.ndim <= 4, 'attention mask must have greater than 2 dimensions but less than or equal to 4'
+                if attn_mask.ndim == 2:
+                    attn_mask = rearrange(attn_mask, 'i j -> () () i j')
+                elif attn_mask.ndim == 3:
+                    attn_mask = rearrange(attn_mask, 'h i j -> () h i j')
+                dots.masked_fill_(~attn_mask, mask_value)
+
+            if exists(self.max_attend_past):
+                i, j = dots.shape[-2:]
+                range_q = torch.arange(j - i, j, device=device)
+                range_k = torch.arange(j, device=device)
+                dist = rearrange(range_q, 'i -> () () i ()') - rearrange(range_k, 'j -> () () () j')
+                mask = dist > self.max_attend_past
+                dots.masked_fill_(mask, mask_value)
+                del mask
+
+            if self.causal:
+                i, j = dots.shape[-2:]
+                r = torch.arange(i, device=device)
+                mask = rearrange(r, 'i -> () () i ()') < rearrange(r, 'j -> () () () j')
+                mask = F.pad(mask, (j - i, 0), value=False)
+                dots.masked_fill_(mask, mask_value)
+                del mask
+
+            if exists(self.sparse_topk) and self.sparse_topk < dots.shape[-1]:
+                top, _ = dots.topk(self.sparse_topk, dim=-1)
+                vk = top[..., -1].unsqueeze(-1).expand_as(dots)
+                mask = dots < vk
+                dots.masked_fill_(mask, mask_value)
+                del mask
+
+            attn = self.attn_fn(dots, dim=-1)
+            post_softmax_attn = attn.clone()
+
+            attn = self.dropout(attn)
+
+            if talking_heads:
+                attn = einsum('b h i j, h k -> b k i j', attn, self.post_softmax_proj).contiguous()
+
+            out = einsum('b h i j, b h j d -> b h i d', attn, v)
 
         if head_scale:
             out = out * self.head_scale_params
@@ -850,6 +908,11 @@ class AttentionLayers(nn.Module):
                 qk_norm_attn_seq_len) else None
             attn_kwargs = {**attn_kwargs, 'qk_norm': True, 'scale_init_value': attn_scale_init_value}
 
+        # residual attention needs the pre-softmax attention matrix, which the fused kernel never materializes
+
+        if residual_attn or cross_residual_attn:
+            attn_kwargs = {k: v for k, v in attn_kwargs.items() if k != 'use_sdpa'}
+
         # zero init
 
         if zero_init_branch_output:
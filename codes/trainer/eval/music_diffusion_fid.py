@@ -141,7 +141,13 @@ class MusicDiffusionFid(evaluator.Evaluator):
         #                                                      model_kwargs = {'truth_mel': mel_norm})
 
         sampler = self.diffuser.ddim_sample_loop if self.ddim else self.diffuser.p_sample_loop
-        gen_mel = sampler(self.model, mel_norm.shape, model_kwargs={'truth_mel': mel_norm})
+        if hasattr(self.model, 'precompute'):
+            # Quantize and embed the reference once rather than on every diffusion step.
+            code_emb = self.model.precompute(mel_norm, mel_norm.shape[-1])
+            gen_mel = sampler(self.model, mel_norm.shape, model_kwargs={'precomputed_code_embeddings': code_emb,
+                                                                        'disable_diversity': True})
+        else:
+            gen_mel = sampler(self.model, mel_norm.shape, model_kwargs={'truth_mel': mel_norm})
 
         gen_mel_denorm = denormalize_torch_mel(gen_mel)
         output_shape = (1,16,audio.shape[-1]//16)
@@ -50,6 +50,30 @@ def find_registered_injectors(base_path="trainer/injectors"):
     return results
 
 
+# Maps injector type names to Injector classes. Populated from trainer/injectors on the first create_injector() call
+# and extended by register_injector().
+_INJECTORS = {}
+_injectors_discovered = False
+
+
+# Decorator that makes an Injector available to create_injector() under the given type name, for injectors that live
+# outside of trainer/injectors. Explicitly registered names take precedence over discovered ones.
+def register_injector(name):
+    def decorator(cls):
+        _INJECTORS[name] = cls
+        return cls
+    return decorator
+
+
+def get_registered_injectors():
+    global _injectors_discovered
+    if not _injectors_discovered:
+        for name, cls in find_registered_injectors().items():
+            _INJECTORS.setdefault(name, cls)
+        _injectors_discovered = True
+    return _INJECTORS
+
+
 class CreateInjectorError(Exception):
     def __init__(self, name, available):
         super().__init__(f'Could not find the specified injector name: {name}.  Available injectors:'
@@ -58,8 +82,8 @@ class CreateInjectorError(Exception):
 
 # Injectors are a way to synthesize data within a step that can then be used (and reused) by loss functions.
 def create_injector(opt_inject, env):
-    injectors = find_registered_injectors()
+    injectors = get_registered_injectors()
     type = opt_inject['type']
     if type not in injectors.keys():
         raise CreateInjectorError(type, list(injectors.keys()))
-    return injectors[opt_inject['type']](opt_inject, env)
+    return injectors[type](opt_inject, env)
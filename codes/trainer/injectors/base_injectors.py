@@ -163,21 +163,25 @@ class AddNoiseInjector(Injector):
 
         ref = state[self.opt['in']]
         if self.mode == 'normal':
-            noise = torch.randn_like(ref) * scale
+            noise = torch.randn_like(ref)
+            if isinstance(scale, (int, float)):
+                return {self.opt['out']: ref.add(noise, alpha=scale)}
+            return {self.opt['out']: ref.addcmul(noise, scale)}
         elif self.mode == 'uniform':
-            noise = torch.FloatTensor(ref.shape).uniform_(0.0, scale).to(ref.device)
-        return {self.opt['out']: state[self.opt['in']] + noise}
+            noise = torch.empty_like(ref).uniform_(0.0, scale)
+        return {self.opt['out']: ref + noise}
 
 
 # Averages the channel dimension (1) of [in] and saves to [out]. Dimensions are
-# kept the same, the average is simply repeated.
+# kept the same, the average is simply broadcast. The output is a stride-0 view;
+# consumers that modify it in-place must call .contiguous() first.
 class GreyInjector(Injector):
     def __init__(self, opt, env):
         super(GreyInjector, self).__init__(opt, env)
 
     def forward(self, state):
         mean = torch.mean(state[self.opt['in']], dim=1, keepdim=True)
-        mean = mean.repeat(1, 3, 1, 1)
+        mean = mean.expand(-1, 3, -1, -1)
         return {self.opt['out']: mean}
 
 